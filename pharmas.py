@@ -1,15 +1,19 @@
 import streamlit as st
 import pandas as pd
-import random
-import time
-from datetime import datetime, timedelta
+import numpy as np
+from datetime import datetime
 import math
 import json
+from collections import deque
 from pathlib import Path
 import pydeck as pdk
-from statistics import mean, pstdev
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
+from pharmasure_core import (
+    DISPLAY_DECIMALS, HISTORY_COLUMNS, RingBuf, Thresholds, due_samples, batch_timestamps,
+    simulate_batch, new_anomaly_stats, anomaly_flags, bump_compliance, compliance_pct, compute_kpis,
+)
+from pharmasure_ui import auto_refresh, full_csv
 
 # --- Constants / Config ---
 PERSIST_FILE = Path("pharmasure_session.csv")
@@ -20,23 +24,34 @@ st.set_page_config(page_title="PharmaSure Simulation", layout="wide")
 st.title("💊 PharmaSure - IoT Drug Transport Monitoring Simulation")
 
 # --- State Init ---
-if "records" not in st.session_state:
+if "ring" not in st.session_state:
+    st.session_state.ring = RingBuf(MAX_HISTORY)
+    st.session_state.persisted_rows = 0  # rows currently in PERSIST_FILE
     if PERSIST_FILE.exists():
-        st.session_state.records = pd.read_csv(PERSIST_FILE, parse_dates=["timestamp"]).to_dict("records")
-    else:
-        st.session_state.records = []
+        df0 = pd.read_csv(PERSIST_FILE, parse_dates=["timestamp"],
+                          dtype={c: np.float64 for c in DISPLAY_DECIMALS})
+        st.session_state.ring.bulk_load(df0)
+        st.session_state.persisted_rows = len(df0)
+        # Autosave only appends, so compact (and normalise older layouts) on load
+        if len(df0) > MAX_HISTORY or list(df0.columns) != list(HISTORY_COLUMNS):
+            st.session_state.ring.tail_df().round(DISPLAY_DECIMALS).to_csv(PERSIST_FILE, index=False)
+            st.session_state.persisted_rows = st.session_state.ring.size
 if "running" not in st.session_state:
     st.session_state.running = False
 if "point_index" not in st.session_state:
-    st.session_state.point_index = len(st.session_state.records)
+    st.session_state.point_index = st.session_state.ring.size
 if "last_alert_flags" not in st.session_state:
     st.session_state.last_alert_flags = (True, True, True)
 if "new_points_since_save" not in st.session_state:
     st.session_state.new_points_since_save = 0
 if "config_loaded" not in st.session_state:
     st.session_state.config_loaded = False
-if "anomaly_baseline" not in st.session_state:
-    st.session_state.anomaly_baseline = {"Temp": [], "Humidity": [], "Shock": []}
+if "anom_stats" not in st.session_state:
+    st.session_state.anom_stats = new_anomaly_stats()
+if "path_coords" not in st.session_state:
+    st.session_state.path_coords = deque()  # [lon, lat] pairs; refilled from the ring once the window is known
+if "compliance_state" not in st.session_state:
+    st.session_state.compliance_state = None
 if "last_sample_time" not in st.session_state:
     st.session_state.last_sample_time = None
 if "next_sample_time" not in st.session_state:
@@ -54,19 +69,26 @@ if c2.button("Stop"):
     st.session_state.running = False
 if c3.button("Reset"):
     st.session_state.running = False
-    st.session_state.records.clear()
+    st.session_state.ring.clear()
     st.session_state.point_index = 0
     st.session_state.last_sample_time = None
     st.session_state.next_sample_time = None
-    st.session_state.anomaly_baseline = {"Temp": [], "Humidity": [], "Shock": []}
+    st.session_state.anom_stats = new_anomaly_stats()
+    st.session_state.compliance_state = None
+    st.session_state.path_coords.clear()
+    st.session_state.pop("rng", None)
+    st.session_state.persisted_rows = 0
     if PERSIST_FILE.exists():
         PERSIST_FILE.unlink()
 
 sampling_interval = st.sidebar.selectbox("Sampling interval (seconds)", [5, 10, 30], index=0)
 max_points_display = st.sidebar.slider("Rolling window points", 50, 1000, 300, 25)
 random_seed = st.sidebar.number_input("Random Seed (0=off)", value=0, step=1)
-if random_seed:
-    random.seed(int(random_seed))
+# One PCG64 generator per session, re-created only when the seed changes (or on Reset)
+if "rng" not in st.session_state or st.session_state.rng_seed != random_seed:
+    st.session_state.rng = np.random.default_rng(int(random_seed) or None)
+    st.session_state.rng_seed = random_seed
+rng = st.session_state.rng
 
 # Add (optional) UI refresh smoothing: adaptive poll interval (ms)
 # Faster refresh for shorter sampling intervals without heavy redraw spam
@@ -75,7 +97,7 @@ poll_interval_ms = {5: 1000, 10: 1500, 30: 2500}[sampling_interval]
 # Trigger lightweight periodic reruns ONLY while running (replaces time.sleep + st.rerun)
 if st.session_state.running:
     # Key stable so autorefresh keeps firing; interval can change when sampling interval changes
-    st.autorefresh(interval=poll_interval_ms, key="rt_autorefresh")
+    auto_refresh(poll_interval_ms, key="rt_autorefresh")
 
 st.sidebar.header("Thresholds")
 temp_min = st.sidebar.number_input("Temp Min (°C)", value=2.0, step=0.5)
@@ -115,69 +137,82 @@ with st.sidebar.expander("Config Import / Export"):
         st.session_state.config_loaded = True
         st.success("Configuration imported.")
 
-# --- Simulation Functions ---
-def simulate_row(idx: int):
-    base_temp = 5 + math.sin(idx / 18) * 1.2
-    temp = round(base_temp + random.uniform(-1.2, 1.2), 2)
-    base_hum = 40 + math.sin(idx / 27) * 6
-    hum = round(base_hum + random.uniform(-4.5, 4.5), 2)
-    hum = max(5, min(95, hum))
-    if random.random() < 0.05:
-        shock = round(random.uniform(6, 11), 2)
-    else:
-        shock = round(random.uniform(0, 4.5), 2)
-    if simulate_dropout and random.random() < 0.02: temp = None
-    if simulate_dropout and random.random() < 0.02: hum = None
-    center_lat, center_lon = 28.61, 77.21
-    radius = 0.004
-    angle = idx / 24
-    lat = round(center_lat + radius * math.cos(angle) + random.uniform(-0.0007, 0.0007), 6)
-    lon = round(center_lon + radius * math.sin(angle) + random.uniform(-0.0007, 0.0007), 6)
-    return {
-        "timestamp": datetime.utcnow(),
-        "Temp": temp,
-        "Humidity": hum,
-        "Shock": shock,
-        "lat": lat,
-        "lon": lon
-    }
+# Effective thresholds (sidebar values or imported config)
+th = Thresholds(temp_min, temp_max, hum_min, hum_max, shock_limit)
 
-def anomaly_flags(row):
-    if not enable_anomaly: return {}
-    out = {}
-    for k in ["Temp", "Humidity", "Shock"]:
-        v = row[k]
-        if v is None:
-            out[k] = False
-            continue
-        baseline = st.session_state.anomaly_baseline[k]
-        if len(baseline) >= 30:
-            mu = mean(baseline)
-            sd = pstdev(baseline) or 1e-6
-            out[k] = abs((v - mu) / sd) > 2.5
-        else:
-            out[k] = False
-        baseline.append(v)
-        if len(baseline) > 300:
-            baseline.pop(0)
-    return out
+# --- Display Helpers ---
+def build_trend_figure():
+    # Built once per session; update_trend_figure only swaps trace data and threshold bands
+    fig = make_subplots(specs=[[{"secondary_y": True}]])
+    fig.add_trace(go.Scattergl(mode="lines+markers", name="Temp", line=dict(color="#ff7f0e"),
+                             hovertemplate="%{y:.2f}"), secondary_y=False)
+    fig.add_trace(go.Scattergl(mode="lines+markers", name="Humidity", line=dict(color="#1f77b4"),
+                             hovertemplate="%{y:.2f}"), secondary_y=False)
+    fig.add_trace(go.Scattergl(mode="lines+markers", name="Shock", line=dict(color="#2ca02c"),
+                             hovertemplate="%{y:.2f}"), secondary_y=True)
+    fig.add_hrect(y0=0, y1=0, fillcolor="orange", opacity=0.08, line_width=0)
+    fig.add_hrect(y0=0, y1=0, fillcolor="blue", opacity=0.06, line_width=0)
+    fig.add_shape(type="rect", xref="x", yref="y2", x0=0, x1=1,
+                  y0=0, y1=0, fillcolor="green", opacity=0.05, line_width=0)
+    fig.update_yaxes(title_text="Temp °C / Humidity %", secondary_y=False)
+    fig.update_yaxes(title_text="Shock", secondary_y=True)
+    fig.update_layout(height=420, margin=dict(l=40,r=40,t=40,b=40),
+                      legend=dict(orientation="h", y=1.02, x=0))
+    return fig
+
+def update_trend_figure(fig, window: dict):
+    # window: ring buffer tail arrays; NaN (dropout) points masked per metric
+    ts, temp, hum, shock = window["timestamp"], window["Temp"], window["Humidity"], window["Shock"]
+    has_t, has_h = ~np.isnan(temp), ~np.isnan(hum)
+    temp_band, hum_band, shock_band = fig.layout.shapes
+    with fig.batch_update():
+        fig.data[0].update(x=ts[has_t], y=temp[has_t])
+        fig.data[1].update(x=ts[has_h], y=hum[has_h])
+        fig.data[2].update(x=ts, y=shock)
+        temp_band.update(y0=temp_min, y1=temp_max)
+        hum_band.update(y0=hum_min, y1=hum_max)
+        shock_band.update(x0=pd.Timestamp(ts.min()) if len(ts) else 0,
+                          x1=pd.Timestamp(ts.max()) if len(ts) else 1,
+                          y1=shock_limit)
+
+def build_route_deck():
+    # Built once per session; layers are fed plain [lon, lat] lists so pydeck never calls to_dict("records")
+    layer_path = pdk.Layer(
+        "PathLayer",
+        data=[{"path": []}],
+        get_path="path",
+        get_color=[0,122,255],
+        width_scale=1,
+        width_min_pixels=2
+    )
+    layer_points = pdk.Layer(
+        "ScatterplotLayer",
+        data=[],
+        get_position="-",
+        get_radius=40,
+        get_fill_color=[255,140,0,150]
+    )
+    layer_latest = pdk.Layer(
+        "ScatterplotLayer",
+        data=[],
+        get_position="-",
+        get_radius=120,
+        get_fill_color=[255,0,0,220]
+    )
+    return pdk.Deck(
+        layers=[layer_path, layer_points, layer_latest],
+        initial_view_state=pdk.ViewState(latitude=28.61, longitude=77.21, zoom=13),
+        tooltip={"text":"Live Route"}
+    )
 
-def compute_kpis(df: pd.DataFrame):
-    if df.empty: return None
-    latest = df.iloc[-1]
-    temp_ok = (latest.Temp is not None) and temp_min <= latest.Temp <= temp_max
-    hum_ok = (latest.Humidity is not None) and hum_min <= latest.Humidity <= hum_max
-    shock_ok = latest.Shock <= shock_limit
-    temp_series = df["Temp"].dropna()
-    hum_series = df["Humidity"].dropna()
-    comp_temp = temp_series.between(temp_min, temp_max).mean()*100 if len(temp_series) else None
-    comp_hum = hum_series.between(hum_min, hum_max).mean()*100 if len(hum_series) else None
-    comp_shock = df["Shock"].le(shock_limit).mean()*100 if len(df) else None
-    return {
-        "latest": latest,
-        "flags": (temp_ok, hum_ok, shock_ok),
-        "compliance": (comp_temp, comp_hum, comp_shock)
-    }
+def update_route_deck(deck, coords: list):
+    layer_path, layer_points, layer_latest = deck.layers
+    layer_path.data = [{"path": coords}]
+    layer_points.data = coords
+    layer_latest.data = coords[-1:]
+    mid_lon, mid_lat = np.mean(coords, axis=0)
+    deck.initial_view_state.latitude = float(mid_lat)
+    deck.initial_view_state.longitude = float(mid_lon)
 
 # --- Sampling (interval driven) ---
 now = datetime.utcnow()
@@ -187,35 +222,51 @@ if st.session_state.running:
         st.session_state.next_sample_time = now
     # Produce sample(s) if we've passed schedule (catch up if server lagged)
     produced = False
-    while now >= st.session_state.next_sample_time:
-        row = simulate_row(st.session_state.point_index)
-        st.session_state.point_index += 1
-        af = anomaly_flags(row)
-        for k, v in af.items():
-            row[f"Anomaly{k}"] = v
-        st.session_state.records.append(row)
-        st.session_state.last_sample_time = row["timestamp"]
-        st.session_state.next_sample_time += timedelta(seconds=sampling_interval)
+    k, next_time = due_samples(now, st.session_state.next_sample_time, sampling_interval)
+    if k:
+        ts = batch_timestamps(now, k, sampling_interval)
+        batch = simulate_batch(rng, st.session_state.point_index, ts, dropout=simulate_dropout)
+        if enable_anomaly:
+            batch.update(anomaly_flags(st.session_state.anom_stats, batch))
+        bump_compliance(st.session_state.compliance_state, th, batch, st.session_state.ring.peek_evicted(k))
+        st.session_state.ring.extend(batch)
+        st.session_state.path_coords.extend(map(list, zip(batch["lon"].tolist(), batch["lat"].tolist())))
+        st.session_state.point_index += k
+        st.session_state.last_sample_time = now
+        st.session_state.next_sample_time = next_time
         produced = True
-        if len(st.session_state.records) > MAX_HISTORY:
-            st.session_state.records = st.session_state.records[-(MAX_HISTORY//2):]
-        st.session_state.new_points_since_save += 1
+        st.session_state.new_points_since_save += k
         if st.session_state.new_points_since_save >= AUTOSAVE_EVERY:
-            pd.DataFrame(st.session_state.records).to_csv(PERSIST_FILE, index=False)
+            ring = st.session_state.ring
+            if st.session_state.persisted_rows + st.session_state.new_points_since_save > 2 * MAX_HISTORY:
+                # Long sessions: rewrite from the ring so the file stays within ~2x MAX_HISTORY rows
+                ring.tail_df().round(DISPLAY_DECIMALS).to_csv(PERSIST_FILE, index=False)
+                st.session_state.persisted_rows = ring.size
+            else:
+                # Append only the unsaved rows instead of rewriting the whole history
+                delta = ring.tail_df(st.session_state.new_points_since_save)
+                delta.round(DISPLAY_DECIMALS).to_csv(PERSIST_FILE, mode="a", header=not PERSIST_FILE.exists(), index=False)
+                st.session_state.persisted_rows += len(delta)
             st.session_state.new_points_since_save = 0
-        # Limit catch-up to avoid long loop
-        if (now - st.session_state.last_sample_time).total_seconds() > sampling_interval*3:
-            break
 
 # --- Data Prep ---
-df = pd.DataFrame(st.session_state.records) if st.session_state.records else pd.DataFrame(
-    columns=["timestamp","Temp","Humidity","Shock","lat","lon"])
-df_display = df.tail(max_points_display).copy()
+ring = st.session_state.ring
+# Most autorefresh reruns land between samples: derived views are rebuilt only when the data,
+# window or thresholds changed; otherwise the cached ones are re-emitted as-is
+render_key = (ring.uid, ring.head, ring.size, max_points_display, th)
+stale = render_key != st.session_state.get("last_render_key")
+if stale:
+    st.session_state.display_df = ring.tail_df(max_points_display)  # zero-copy view
+    st.session_state.compliance_state, compliance = compliance_pct(st.session_state.compliance_state, ring, th)
+    st.session_state.kpi = compute_kpis(ring, th, compliance)
+    st.session_state.last_render_key = render_key
+df_display = st.session_state.display_df
+kpi = st.session_state.kpi
 
 # --- Header Status Bar ---
 status_cols = st.columns(5)
 status_cols[0].markdown(f"**Running:** {'🟢' if st.session_state.running else '🔴'}")
-status_cols[1].markdown(f"**Samples:** {len(df)}")
+status_cols[1].markdown(f"**Samples:** {ring.size}")
 if st.session_state.last_sample_time:
     status_cols[2].markdown(f"**Last:** {st.session_state.last_sample_time.strftime('%H:%M:%S')}")
 else:
@@ -227,26 +278,25 @@ else:
 status_cols[4].markdown(f"**Interval:** {sampling_interval}s")
 
 # --- KPIs & Alerts ---
-kpi = compute_kpis(df)
 alert_placeholder = st.empty()
 if kpi:
-    latest = kpi["latest"]
-    temp_ok, hum_ok, shock_ok = kpi["flags"]
-    comp_t, comp_h, comp_s = kpi["compliance"]
+    temp_ok, hum_ok, shock_ok = kpi.flags
+    comp_t, comp_h, comp_s = kpi.compliance
     colk = st.columns(4)
-    colk[0].metric("Temp (°C)", latest.Temp if latest.Temp is not None else "—", None if temp_ok else "⚠")
-    colk[1].metric("Humidity (%)", latest.Humidity if latest.Humidity is not None else "—", None if hum_ok else "⚠")
-    colk[2].metric("Shock", latest.Shock, None if shock_ok else "⚠")
-    comp_txt = f"T:{comp_t:.1f}% H:{comp_h:.1f}% S:{comp_s:.1f}%" if comp_t is not None else "—"
+    colk[0].metric("Temp (°C)", "—" if math.isnan(kpi.temp) else f"{kpi.temp:.2f}", None if temp_ok else "⚠")
+    colk[1].metric("Humidity (%)", "—" if math.isnan(kpi.hum) else f"{kpi.hum:.2f}", None if hum_ok else "⚠")
+    colk[2].metric("Shock", f"{kpi.shock:.2f}", None if shock_ok else "⚠")
+    comp_txt = " ".join(f"{m}:{c:.1f}%" if c is not None else f"{m}:—"
+                        for m, c in zip("THS", (comp_t, comp_h, comp_s)))
     colk[3].metric("Compliance", comp_txt)
 
     prev = st.session_state.last_alert_flags
     curr = (temp_ok, hum_ok, shock_ok)
     if curr != prev:
         msgs = []
-        if not temp_ok: msgs.append(f"Temp {latest.Temp}°C out of range")
-        if not hum_ok: msgs.append(f"Humidity {latest.Humidity}% out of range")
-        if not shock_ok: msgs.append(f"Shock {latest.Shock} > {shock_limit}")
+        if not temp_ok: msgs.append(f"Temp {kpi.temp:.2f}°C out of range")
+        if not hum_ok: msgs.append(f"Humidity {kpi.hum:.2f}% out of range")
+        if not shock_ok: msgs.append(f"Shock {kpi.shock:.2f} > {shock_limit}")
         if msgs:
             alert_placeholder.error(" | ".join(msgs))
             if audible_alert:
@@ -261,74 +311,41 @@ left, right = st.columns([2.1, 1])
 with left:
     st.subheader("📈 Sensor Trends")
     if not df_display.empty:
-        temp_trace = df_display[["timestamp","Temp"]].dropna()
-        hum_trace = df_display[["timestamp","Humidity"]].dropna()
-        shock_trace = df_display[["timestamp","Shock"]]
-        fig = make_subplots(specs=[[{"secondary_y": True}]])
-        if not temp_trace.empty:
-            fig.add_trace(go.Scatter(x=temp_trace.timestamp, y=temp_trace.Temp, mode="lines+markers",
-                                     name="Temp", line=dict(color="#ff7f0e")), secondary_y=False)
-        if not hum_trace.empty:
-            fig.add_trace(go.Scatter(x=hum_trace.timestamp, y=hum_trace.Humidity, mode="lines+markers",
-                                     name="Humidity", line=dict(color="#1f77b4")), secondary_y=False)
-        fig.add_trace(go.Scatter(x=shock_trace.timestamp, y=shock_trace.Shock, mode="lines+markers",
-                                 name="Shock", line=dict(color="#2ca02c")), secondary_y=True)
-        fig.add_hrect(y0=temp_min, y1=temp_max, fillcolor="orange", opacity=0.08, line_width=0)
-        fig.add_hrect(y0=hum_min, y1=hum_max, fillcolor="blue", opacity=0.06, line_width=0)
-        fig.add_shape(type="rect", xref="x", yref="y2",
-                      x0=shock_trace.timestamp.min() if len(shock_trace) else 0,
-                      x1=shock_trace.timestamp.max() if len(shock_trace) else 1,
-                      y0=0, y1=shock_limit, fillcolor="green", opacity=0.05, line_width=0)
-        fig.update_yaxes(title_text="Temp °C / Humidity %", secondary_y=False)
-        fig.update_yaxes(title_text="Shock", secondary_y=True)
-        fig.update_layout(height=420, margin=dict(l=40,r=40,t=40,b=40),
-                          legend=dict(orientation="h", y=1.02, x=0))
-        st.plotly_chart(fig, use_container_width=True)
+        if stale or "trend_fig" not in st.session_state:
+            if "trend_fig" not in st.session_state:
+                st.session_state.trend_fig = build_trend_figure()
+            update_trend_figure(st.session_state.trend_fig, ring.tail(max_points_display))
+        fig = st.session_state.trend_fig
+        st.plotly_chart(fig, key="trend", use_container_width=True)
     else:
         st.info("No data yet.")
 
     st.subheader("🧾 Data (Rolling Window)")
-    st.dataframe(df_display, use_container_width=True, height=280)
+    st.dataframe(df_display, use_container_width=True, height=280,
+                 column_config={c: st.column_config.NumberColumn(format=f"%.{d}f")
+                                for c, d in DISPLAY_DECIMALS.items()})
 
 with right:
     st.subheader("🗺️ Live Route")
     if not df_display.empty:
-        latest_point = df_display.tail(1)
-        layer_path = pdk.Layer(
-            "PathLayer",
-            data=[{"path": df_display[["lon","lat"]].to_dict("records")}],
-            get_path="path",
-            get_color=[0,122,255],
-            width_scale=1,
-            width_min_pixels=2
-        )
-        layer_points = pdk.Layer(
-            "ScatterplotLayer",
-            data=df_display,
-            get_position='[lon, lat]',
-            get_radius=40,
-            get_fill_color=[255,140,0,150]
-        )
-        layer_latest = pdk.Layer(
-            "ScatterplotLayer",
-            data=latest_point,
-            get_position='[lon, lat]',
-            get_radius=120,
-            get_fill_color=[255,0,0,220]
-        )
-        midpoint = [df_display.lat.mean(), df_display.lon.mean()]
-        deck = pdk.Deck(
-            layers=[layer_path, layer_points, layer_latest],
-            initial_view_state=pdk.ViewState(latitude=midpoint[0], longitude=midpoint[1], zoom=13),
-            tooltip={"text":"Live Route"}
-        )
+        coords = st.session_state.path_coords
+        if coords.maxlen != max_points_display:
+            # Window changed (or first render): refill from the ring buffer
+            window = ring.tail(max_points_display)
+            coords = st.session_state.path_coords = deque(
+                map(list, zip(window["lon"].tolist(), window["lat"].tolist())), maxlen=max_points_display)
+        if stale or "route_deck" not in st.session_state:
+            if "route_deck" not in st.session_state:
+                st.session_state.route_deck = build_route_deck()
+            update_route_deck(st.session_state.route_deck, list(coords))
+        deck = st.session_state.route_deck
         st.pydeck_chart(deck)
     else:
         st.info("No location data.")
 
     st.subheader("⚠️ Current Status")
     if kpi:
-        temp_ok, hum_ok, shock_ok = kpi["flags"]
+        temp_ok, hum_ok, shock_ok = kpi.flags
         st.write(f"Temperature: {'OK' if temp_ok else 'BREACH'}")
         st.write(f"Humidity: {'OK' if hum_ok else 'BREACH'}")
         st.write(f"Shock: {'OK' if shock_ok else 'BREACH'}")
@@ -337,7 +354,8 @@ with right:
         if anomaly_cols:
             counts = {c: int(df_display[c].sum()) for c in anomaly_cols}
             st.caption(f"Anomalies (window): {counts}")
-    if not df.empty:
-        st.download_button("Download Full CSV", df.to_csv(index=False), "pharmasure_log.csv", "text/csv")
+    if ring.size:
+        st.download_button("Download Full CSV", full_csv(ring),
+                           "pharmasure_log.csv", "text/csv")
 
 # --- Auto refresh loop (light polling every 1s while running) ---
\ No newline at end of file
@@ -1,41 +1,57 @@
 import streamlit as st
-import pandas as pd
-import random
-import time
+import numpy as np
 from datetime import datetime
 import plotly.express as px
-import math
+from pharmasure_core import (
+    BASIC_PROFILE, DISPLAY_DECIMALS, SENSOR_COLUMNS, RingBuf, Thresholds,
+    due_samples, batch_timestamps, simulate_batch, compute_kpis,
+)
+from pharmasure_ui import auto_refresh, full_csv
+
+MAX_HISTORY = 5000
 
 st.set_page_config(page_title="PharmaSure Simulation", layout="wide")
 st.title("💊 PharmaSure - IoT Drug Transport Monitoring Simulation")
 
 # --- Session State Initialization ---
-if "records" not in st.session_state:
-    st.session_state.records = []          # list of dict rows
+if "ring" not in st.session_state:
+    st.session_state.ring = RingBuf(MAX_HISTORY, SENSOR_COLUMNS)
 if "running" not in st.session_state:
     st.session_state.running = False
 if "last_alert_states" not in st.session_state:
     st.session_state.last_alert_states = {"temp": False, "hum": False, "shock": False}
 if "point_index" not in st.session_state:
     st.session_state.point_index = 0       # for route simulation
+if "next_sample_time" not in st.session_state:
+    st.session_state.next_sample_time = None
 
 # --- Sidebar Controls ---
 st.sidebar.header("Simulation Controls")
 col_a, col_b = st.sidebar.columns(2)
 if col_a.button("Start"):
     st.session_state.running = True
+    st.session_state.next_sample_time = datetime.utcnow()
 if col_b.button("Stop"):
     st.session_state.running = False
 if st.sidebar.button("Reset"):
     st.session_state.running = False
-    st.session_state.records.clear()
+    st.session_state.ring.clear()
     st.session_state.point_index = 0
+    st.session_state.next_sample_time = None
+    st.session_state.pop("rng", None)
 
 update_interval = st.sidebar.selectbox("Update interval (s)", [0.5, 1, 2], index=0)
 max_points_display = st.sidebar.slider("Points to display (rolling window)", 20, 500, 150, 10)
 random_seed = st.sidebar.number_input("Random Seed (optional)", value=0, step=1)
-if random_seed:
-    random.seed(int(random_seed))
+# One generator per session, re-created only when the seed changes (or on Reset)
+if "rng" not in st.session_state or st.session_state.rng_seed != random_seed:
+    st.session_state.rng = np.random.default_rng(int(random_seed) or None)
+    st.session_state.rng_seed = random_seed
+rng = st.session_state.rng
+
+# Non-blocking periodic reruns while running (no sleep holding the script thread)
+if st.session_state.running:
+    auto_refresh(update_interval * 1000, key="ps_tick")
 
 st.sidebar.header("Thresholds")
 temp_min = st.sidebar.number_input("Temp Min (°C)", value=2.0, step=0.5)
@@ -44,71 +60,31 @@ hum_min = st.sidebar.number_input("Humidity Min (%)", value=30.0, step=1.0)
 hum_max = st.sidebar.number_input("Humidity Max (%)", value=50.0, step=1.0)
 shock_limit = st.sidebar.number_input("Shock Limit", value=5.0, step=0.5)
 
-# --- Simulation Function ---
-def simulate_row(idx: int):
-    # Temperature (introduce mild drift)
-    base_temp = 5 + math.sin(idx / 15) * 1.2
-    temp = round(base_temp + random.uniform(-1.5, 1.5), 2)
+th = Thresholds(temp_min, temp_max, hum_min, hum_max, shock_limit)
 
-    # Humidity (bounded)
-    base_hum = 40 + math.sin(idx / 22) * 5
-    hum = round(base_hum + random.uniform(-4, 4), 2)
-    hum = max(10, min(90, hum))
-
-    # Shock events (mostly low, occasional spike)
-    if random.random() < 0.06:
-        shock = round(random.uniform(6, 10), 2)
-    else:
-        shock = round(random.uniform(0, 4), 2)
-
-    # Route simulation (simple circular drift near a center)
-    center_lat, center_lon = 28.61, 77.21
-    radius = 0.004
-    angle = idx / 25
-    lat = round(center_lat + radius * math.cos(angle) + random.uniform(-0.0007, 0.0007), 6)
-    lon = round(center_lon + radius * math.sin(angle) + random.uniform(-0.0007, 0.0007), 6)
-
-    now = datetime.utcnow()
-    return {
-        "timestamp": now,
-        "Temp": temp,
-        "Humidity": hum,
-        "Shock": shock,
-        "Lat": lat,
-        "Lon": lon
-    }
-
-# --- Update Loop (single step per rerun) ---
+# --- Update Loop (interval driven; reruns from widget changes add no samples) ---
+now = datetime.utcnow()
 if st.session_state.running:
-    # Append one new simulated reading
-    row = simulate_row(st.session_state.point_index)
-    st.session_state.records.append(row)
-    st.session_state.point_index += 1
-    # Sleep only when running (keeps UI responsive enough)
-    time.sleep(update_interval)
+    if st.session_state.next_sample_time is None:
+        st.session_state.next_sample_time = now
+    k, st.session_state.next_sample_time = due_samples(now, st.session_state.next_sample_time, update_interval)
+    if k:
+        ts = batch_timestamps(now, k, update_interval)
+        st.session_state.ring.extend(simulate_batch(rng, st.session_state.point_index, ts, BASIC_PROFILE))
+        st.session_state.point_index += k
 
 # --- DataFrame Assembly ---
-if st.session_state.records:
-    df = pd.DataFrame(st.session_state.records)
-    df_display = df.tail(max_points_display).copy()
-else:
-    df = pd.DataFrame(columns=["timestamp", "Temp", "Humidity", "Shock", "Lat", "Lon"])
-    df_display = df
+ring = st.session_state.ring
+df_display = ring.tail_df(max_points_display)
 
 # --- KPI Calculations ---
-def in_range(val, lo, hi):
-    return lo <= val <= hi
-
-if not df.empty:
-    latest = df.iloc[-1]
-    temp_ok = in_range(latest.Temp, temp_min, temp_max)
-    hum_ok = in_range(latest.Humidity, hum_min, hum_max)
-    shock_ok = latest.Shock <= shock_limit
-
+kpi = compute_kpis(ring, th)
+if kpi:
+    temp_ok, hum_ok, shock_ok = kpi.flags
     kpi_cols = st.columns(3)
-    kpi_cols[0].metric("Temperature (°C)", latest.Temp, None if temp_ok else "⚠")
-    kpi_cols[1].metric("Humidity (%)", latest.Humidity, None if hum_ok else "⚠")
-    kpi_cols[2].metric("Shock", latest.Shock, None if shock_ok else "⚠")
+    kpi_cols[0].metric("Temperature (°C)", f"{kpi.temp:.2f}", None if temp_ok else "⚠")
+    kpi_cols[1].metric("Humidity (%)", f"{kpi.hum:.2f}", None if hum_ok else "⚠")
+    kpi_cols[2].metric("Shock", f"{kpi.shock:.2f}", None if shock_ok else "⚠")
 
 # --- Layout ---
 left, right = st.columns([2, 1])
@@ -126,26 +102,26 @@ with left:
         st.info("No data yet.")
 
     st.subheader("🧾 Data (Rolling Window)")
-    st.dataframe(df_display.rename(columns={"timestamp": "Time (UTC)"}), use_container_width=True, height=280)
+    st.dataframe(df_display.rename(columns={"timestamp": "Time (UTC)"}), use_container_width=True, height=280,
+                 column_config={c: st.column_config.NumberColumn(format=f"%.{d}f")
+                                for c, d in DISPLAY_DECIMALS.items()})
 
 with right:
     st.subheader("🗺️ Route")
     if not df_display.empty:
-        # Rename to lowercase for Streamlit's required column names
-        map_df = df_display.rename(columns={"Lat": "lat", "Lon": "lon"})
-        st.map(map_df[["lat", "lon"]])
+        st.map(df_display[["lat", "lon"]])
     else:
         st.info("No location data.")
 
     st.subheader("⚠️ Alerts")
-    if not df.empty:
+    if kpi:
         alerts = []
         if not temp_ok:
-            alerts.append(f"Temperature out of range: {latest.Temp}°C")
+            alerts.append(f"Temperature out of range: {kpi.temp:.2f}°C")
         if not hum_ok:
-            alerts.append(f"Humidity out of range: {latest.Humidity}%")
+            alerts.append(f"Humidity out of range: {kpi.hum:.2f}%")
         if not shock_ok:
-            alerts.append(f"Shock exceeded: {latest.Shock}")
+            alerts.append(f"Shock exceeded: {kpi.shock:.2f}")
 
         if alerts:
             for a in alerts:
@@ -155,9 +131,5 @@ with right:
     else:
         st.info("Waiting for first reading...")
 
-    if not df.empty:
-        st.download_button("Download CSV", df.to_csv(index=False), file_name="pharmasure_log.csv", mime="text/csv")
-
-# Auto-rerun while running
-if st.session_state.running:
-    st.experimental_rerun()
+    if ring.size:
+        st.download_button("Download CSV", full_csv(ring), file_name="pharmasure_log.csv", mime="text/csv")
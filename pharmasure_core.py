@@ -0,0 +1,263 @@
+"""Simulation, history buffer and KPI kernels shared by pharmas.py and pharmasure.py (no Streamlit calls)."""
+import math
+import uuid
+from collections import namedtuple
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+try:
+    import numba
+except ImportError:  # optional: the NumPy kernels below are used instead
+    numba = None
+
+# Values are stored at full precision and rounded only for display / CSV output
+DISPLAY_DECIMALS = {"Temp": 2, "Humidity": 2, "Shock": 2, "lat": 6, "lon": 6}
+# column -> (dtype, fill value for missing readings)
+SENSOR_COLUMNS = {
+    "timestamp": ("datetime64[us]", np.datetime64("NaT")),
+    "Temp": (np.float64, np.nan),
+    "Humidity": (np.float64, np.nan),
+    "Shock": (np.float64, np.nan),
+    "lat": (np.float64, np.nan),
+    "lon": (np.float64, np.nan),
+}
+HISTORY_COLUMNS = {
+    **SENSOR_COLUMNS,
+    "AnomalyTemp": (np.bool_, False),
+    "AnomalyHumidity": (np.bool_, False),
+    "AnomalyShock": (np.bool_, False),
+}
+
+# Metrics screened for anomalies; anomaly stats arrays have one column per metric
+ANOMALY_METRICS = ["Temp", "Humidity", "Shock"]
+
+Thresholds = namedtuple("Thresholds", ["temp_min", "temp_max", "hum_min", "hum_max", "shock_limit"])
+KPI = namedtuple("KPI", ["temp", "hum", "shock", "flags", "compliance"])
+
+# Shape of the simulated signals (drift periods, noise amplitudes, bounds, shock spikes, route speed)
+SimProfile = namedtuple("SimProfile", [
+    "temp_period", "temp_noise", "hum_period", "hum_amp", "hum_noise", "hum_lo", "hum_hi",
+    "spike_prob", "spike_lo", "spike_hi", "shock_hi", "route_period",
+])
+ADVANCED_PROFILE = SimProfile(18, 1.2, 27, 6, 4.5, 5, 95, 0.05, 6, 11, 4.5, 24)
+BASIC_PROFILE = SimProfile(15, 1.5, 22, 5, 4, 10, 90, 0.06, 6, 10, 4, 25)
+# Signal bases shared by both profiles; the route is a small loop around ROUTE_CENTER
+TEMP_BASE, TEMP_SWING, HUM_BASE = 5.0, 1.2, 40.0
+ROUTE_CENTER = (28.61, 77.21)
+ROUTE_RADIUS, ROUTE_JITTER = 0.004, 0.0007
+
+# Anomaly screening: z-score cut-off, warm-up samples before flagging, EWMA window, sd floor
+ANOMALY_Z = 2.5
+ANOMALY_MIN_SAMPLES = 30
+ANOMALY_WINDOW = 300
+ANOMALY_SD_FLOOR = 1e-6
+
+
+# --- History Buffer ---
+class RingBuf:
+    """Fixed-capacity columnar history; once full, the oldest rows are overwritten."""
+
+    def __init__(self, cap: int, columns: dict = HISTORY_COLUMNS):
+        self.cap = cap
+        self.columns = columns
+        self.cols = {c: np.empty(cap, dtype=dt) for c, (dt, _) in columns.items()}
+        self.head = 0  # next slot to write
+        self.size = 0
+        self.uid = uuid.uuid4().hex  # distinguishes buffers (and resets) in cache keys
+
+    def clear(self):
+        self.head = 0
+        self.size = 0
+        self.uid = uuid.uuid4().hex
+
+    def bulk_load(self, df: pd.DataFrame):
+        """Replace the contents with the last cap rows of df, column by column."""
+        df = df.tail(self.cap)
+        self.clear()
+        self.extend({c: df[c].fillna(fill).to_numpy(dtype=dt) if c in df else fill
+                     for c, (dt, fill) in self.columns.items()})
+
+    def tail(self, n=None) -> dict:
+        """Last n rows (all if None) as column arrays, oldest first; views unless the window wraps."""
+        n = self.size if n is None else min(n, self.size)
+        start = (self.head - n) % self.cap
+        if start + n <= self.cap:
+            return {c: arr[start:start + n] for c, arr in self.cols.items()}
+        return {c: np.concatenate((arr[start:], arr[:self.head])) for c, arr in self.cols.items()}
+
+    def tail_df(self, n=None) -> pd.DataFrame:
+        # Wraps the tail arrays without copying them
+        return pd.DataFrame(self.tail(n), copy=False)
+
+    def latest(self, col: str):
+        return self.cols[col][(self.head - 1) % self.cap]
+
+    def used(self) -> dict:
+        """All stored rows as column views, in slot order rather than time order."""
+        return {c: arr[:self.size] for c, arr in self.cols.items()}
+
+    def peek_evicted(self, k: int) -> dict:
+        """Rows (oldest first) that extending by k rows would overwrite."""
+        slots = (self.head - self.size + np.arange(max(0, self.size + k - self.cap))) % self.cap
+        return {c: arr[slots] for c, arr in self.cols.items()}
+
+    def extend(self, batch: dict):
+        """Write k rows given as column arrays; columns missing from batch get their fill value."""
+        k = len(batch["timestamp"])
+        slots = (self.head + np.arange(k)) % self.cap
+        for c, arr in self.cols.items():
+            arr[slots] = batch[c] if c in batch else self.columns[c][1]
+        self.head = (self.head + k) % self.cap
+        self.size = min(self.size + k, self.cap)
+
+
+# --- Scheduling ---
+def due_samples(now, next_sample_time, interval_s: float, max_batch: int = 3):
+    """(k, next slot time): how many slots are due, capped so a stalled session doesn't burst."""
+    if now < next_sample_time:
+        return 0, next_sample_time
+    interval = timedelta(seconds=interval_s)
+    k = min(int((now - next_sample_time) / interval) + 1, max_batch)
+    next_sample_time += k * interval
+    if next_sample_time <= now:
+        next_sample_time = now + interval
+    return k, next_sample_time
+
+def batch_timestamps(now, k: int, interval_s: float) -> np.ndarray:
+    # Latest sample stamped now, caught-up ones backfilled one interval apart
+    step = np.timedelta64(int(interval_s * 1000), "ms")
+    return np.datetime64(now, "us") - np.arange(k - 1, -1, -1) * step
+
+
+# --- Simulation ---
+# Kernels take the profile as a SimProfile of floats and six uniform [0, 1) draws per sample:
+# temp noise, humidity noise, spike test, shock magnitude, lat jitter, lon jitter
+def _simulate_numpy(start_idx, u, p, out):
+    idx = np.arange(start_idx, start_idx + len(u))
+    out[0] = TEMP_BASE + np.sin(idx / p.temp_period) * TEMP_SWING + (2 * u[:, 0] - 1) * p.temp_noise
+    hum = HUM_BASE + np.sin(idx / p.hum_period) * p.hum_amp + (2 * u[:, 1] - 1) * p.hum_noise
+    out[1] = np.clip(hum, p.hum_lo, p.hum_hi)
+    spike = p.spike_lo + u[:, 3] * (p.spike_hi - p.spike_lo)
+    out[2] = np.where(u[:, 2] < p.spike_prob, spike, u[:, 3] * p.shock_hi)
+    angle = idx / p.route_period
+    out[3] = ROUTE_CENTER[0] + ROUTE_RADIUS * np.cos(angle) + (2 * u[:, 4] - 1) * ROUTE_JITTER
+    out[4] = ROUTE_CENTER[1] + ROUTE_RADIUS * np.sin(angle) + (2 * u[:, 5] - 1) * ROUTE_JITTER
+
+def _simulate_loop(start_idx, u, p, out):
+    # Scalar form of _simulate_numpy for numba (module constants are frozen in at compile time)
+    for i in range(u.shape[0]):
+        x = start_idx + i
+        out[0, i] = TEMP_BASE + math.sin(x / p.temp_period) * TEMP_SWING + (2 * u[i, 0] - 1) * p.temp_noise
+        hum = HUM_BASE + math.sin(x / p.hum_period) * p.hum_amp + (2 * u[i, 1] - 1) * p.hum_noise
+        out[1, i] = min(max(hum, p.hum_lo), p.hum_hi)
+        if u[i, 2] < p.spike_prob:
+            out[2, i] = p.spike_lo + u[i, 3] * (p.spike_hi - p.spike_lo)
+        else:
+            out[2, i] = u[i, 3] * p.shock_hi
+        angle = x / p.route_period
+        out[3, i] = ROUTE_CENTER[0] + ROUTE_RADIUS * math.cos(angle) + (2 * u[i, 4] - 1) * ROUTE_JITTER
+        out[4, i] = ROUTE_CENTER[1] + ROUTE_RADIUS * math.sin(angle) + (2 * u[i, 5] - 1) * ROUTE_JITTER
+
+_simulate_kernel = numba.njit(cache=True, fastmath=True)(_simulate_loop) if numba else _simulate_numpy
+
+def simulate_batch(rng: np.random.Generator, start_idx: int, ts: np.ndarray,
+                   profile: SimProfile = ADVANCED_PROFILE, dropout: bool = False) -> dict:
+    # ts: datetime64[us] stamps, one per sample; stored as-is in the ring buffer
+    k = len(ts)
+    out = np.empty((5, k))
+    _simulate_kernel(start_idx, rng.random((k, 6)), SimProfile._make(map(float, profile)), out)
+    temp, hum, shock, lat, lon = out
+    if dropout:
+        temp[rng.random(k) < 0.02] = np.nan
+        hum[rng.random(k) < 0.02] = np.nan
+    return {
+        "timestamp": ts,
+        "Temp": temp,
+        "Humidity": hum,
+        "Shock": shock,
+        "lat": lat,
+        "lon": lon
+    }
+
+
+# --- Anomalies ---
+def new_anomaly_stats() -> np.ndarray:
+    # rows (n, mean, var), one column per metric
+    return np.zeros((3, len(ANOMALY_METRICS)))
+
+# Welford (exact mean/variance) for the first ANOMALY_WINDOW samples, then EWMA with alpha=1/ANOMALY_WINDOW;
+# NaN (dropout) readings are never flagged and leave their metric's stats untouched
+def _anomaly_numpy(vals, stats, flags):
+    n, mu, var = stats  # row views
+    for i, v in enumerate(vals):
+        ok = ~np.isnan(v)
+        sd = np.where(var > 0, np.sqrt(var), ANOMALY_SD_FLOOR)
+        flags[i] = ok & (n >= ANOMALY_MIN_SAMPLES) & (np.abs(v - mu) / sd > ANOMALY_Z)
+        n += ok
+        a = np.where(ok, 1 / np.clip(n, 1, ANOMALY_WINDOW), 0.0)
+        delta = np.where(ok, v - mu, 0.0)
+        mu += a * delta
+        var[:] = (1 - a) * (var + a * delta * delta)
+
+def _anomaly_loop(vals, stats, flags):
+    # Scalar form of _anomaly_numpy for numba (no fastmath: it relies on NaN checks)
+    for i in range(vals.shape[0]):
+        for j in range(vals.shape[1]):
+            v = vals[i, j]
+            if math.isnan(v):
+                continue
+            n, mu, var = stats[0, j], stats[1, j], stats[2, j]
+            if n >= ANOMALY_MIN_SAMPLES:
+                sd = math.sqrt(var) if var > 0 else ANOMALY_SD_FLOOR
+                flags[i, j] = abs(v - mu) / sd > ANOMALY_Z
+            n += 1
+            a = 1 / min(n, float(ANOMALY_WINDOW))
+            delta = v - mu
+            mu += a * delta
+            stats[0, j], stats[1, j], stats[2, j] = n, mu, (1 - a) * (var + a * delta * delta)
+
+_anomaly_kernel = numba.njit(cache=True)(_anomaly_loop) if numba else _anomaly_numpy
+
+def anomaly_flags(stats: np.ndarray, batch: dict) -> dict:
+    """z > ANOMALY_Z flags per row and metric; updates stats in place."""
+    vals = np.stack([batch[m] for m in ANOMALY_METRICS], axis=1)  # (k, metrics)
+    flags = np.zeros(vals.shape, dtype=np.bool_)
+    _anomaly_kernel(vals, stats, flags)
+    return {f"Anomaly{m}": flags[:, j] for j, m in enumerate(ANOMALY_METRICS)}
+
+
+# --- KPIs ---
+def compliance_counts(cols: dict, th: Thresholds) -> dict:
+    # (in range, total) per metric; dropped-out (NaN) readings are not counted
+    t, h, sh = cols["Temp"], cols["Humidity"], cols["Shock"]
+    return {
+        "temp": (np.count_nonzero((t >= th.temp_min) & (t <= th.temp_max)), np.count_nonzero(~np.isnan(t))),
+        "hum": (np.count_nonzero((h >= th.hum_min) & (h <= th.hum_max)), np.count_nonzero(~np.isnan(h))),
+        "shock": (np.count_nonzero(sh <= th.shock_limit), len(sh)),
+    }
+
+def bump_compliance(state, th: Thresholds, added: dict, removed: dict):
+    # Counters are only valid for the thresholds they were tallied with; stale ones get rebuilt in compliance_pct
+    if state is None or state["key"] != th:
+        return
+    add, rem = compliance_counts(added, th), compliance_counts(removed, th)
+    for m in ["temp", "hum", "shock"]:
+        state[m] = (state[m][0] + add[m][0] - rem[m][0], state[m][1] + add[m][1] - rem[m][1])
+
+def compliance_pct(state, ring: RingBuf, th: Thresholds):
+    """(state, percentages); state is re-tallied over the ring when missing or stale."""
+    if state is None or state["key"] != th:
+        state = {"key": th, **compliance_counts(ring.used(), th)}
+    pct = tuple(ok / total * 100 if total else None for ok, total in (state[m] for m in ["temp", "hum", "shock"]))
+    return state, pct
+
+def compute_kpis(ring: RingBuf, th: Thresholds, compliance=None):
+    if not ring.size: return None
+    temp, hum, shock = ring.latest("Temp"), ring.latest("Humidity"), ring.latest("Shock")
+    # NaN (dropout) compares False, so a missing reading counts as out of range
+    temp_ok = bool(th.temp_min <= temp <= th.temp_max)
+    hum_ok = bool(th.hum_min <= hum <= th.hum_max)
+    shock_ok = bool(shock <= th.shock_limit)
+    return KPI(temp, hum, shock, (temp_ok, hum_ok, shock_ok), compliance)
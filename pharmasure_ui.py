@@ -0,0 +1,19 @@
+"""Streamlit helpers shared by pharmas.py and pharmasure.py."""
+import streamlit as st
+from streamlit_autorefresh import st_autorefresh
+
+from pharmasure_core import DISPLAY_DECIMALS, RingBuf
+
+
+def auto_refresh(interval_ms, key):
+    """Schedule a non-blocking rerun every `interval_ms` (call only while the simulation is running)."""
+    st_autorefresh(interval=int(interval_ms), key=key)
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _csv_bytes(_ring: RingBuf, uid: str, head: int, size: int) -> bytes:
+    return _ring.tail_df().round(DISPLAY_DECIMALS).to_csv(index=False).encode()
+
+def full_csv(ring: RingBuf) -> bytes:
+    """Whole history as rounded CSV; only re-serialized when a sample arrives, not on every rerun."""
+    return _csv_bytes(ring, ring.uid, ring.head, ring.size)